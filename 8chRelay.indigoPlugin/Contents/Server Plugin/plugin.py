@@ -4,11 +4,541 @@
     License: GPLv2
 """
 
+from collections import deque
 from datetime import datetime
 from telnetlib import Telnet
+import heapq
+import Queue
+import re
 import socket
+import threading
+import time
 import indigo
 
+# Longest a failing board is left alone before the plugin tries it again.
+MAX_RETRY_COOLDOWN = 600
+# The board hangs up after 30 seconds without data; reconnect before that happens.
+IDLE_TIMEOUT = 25
+# How long a board is polled at the burst interval after an action or input change.
+BURST_DURATION = 10
+# A relay-only board with no changes for this many seconds is polled less often...
+IDLE_AFTER = 300
+# ...at this multiple of the normal interval.
+IDLE_MULTIPLIER = 4
+# Times a command is resent when the read-back shows the relay did not switch.
+CONFIRM_RETRIES = 2
+# Board Status devices are refreshed at most this often, in seconds.
+STATUS_INTERVAL = 5
+# Number of samples kept by each latency histogram.
+HISTOGRAM_SIZE = 256
+# How often buffered event log messages are written, in seconds.
+LOG_FLUSH_INTERVAL = 1
+# One status line of a DUMP reply, like "Relayon 1" or "IL 8".
+DUMP_LINE = re.compile(r"^\s*(RELAYON|RELAYOFF|IH|IL)\s+(\d+)\s*$", re.IGNORECASE | re.MULTILINE)
+
+
+def board_key(host, port):
+    """ Returns the key used to track a board: a (hostname, int port) tuple. """
+    return (host, int(port))
+
+
+class ConfirmError(Exception):
+    """ Raised when a relay does not reach the commanded state. """
+
+
+class BoardState(object):
+    """ A snapshot of one board's relays and inputs, held as bitmasks. """
+    __slots__ = ("relays", "inputs")
+
+    def __init__(self, relays=0, inputs=0):
+        self.relays = relays
+        self.inputs = inputs
+
+    def relay(self, chan):
+        """ Returns True if the relay on this channel is on. """
+        return chan > 0 and bool(self.relays >> (chan - 1) & 1)
+
+    def input(self, chan):
+        """ Returns True if the input on this channel is high. """
+        return chan > 0 and bool(self.inputs >> (chan - 1) & 1)
+
+    def set_relay(self, chan, state):
+        """ Record a relay change made by a command. """
+        if state:
+            self.relays |= 1 << (chan - 1)
+        else:
+            self.relays &= ~(1 << (chan - 1))
+
+
+def parse_dump(reply):
+    """ Parses a DUMP reply into a BoardState. Raises ValueError if the reply
+    does not end with OK, which means it was cut short. """
+    if not reply.rstrip().upper().endswith("OK"):
+        raise ValueError(u"incomplete DUMP reply")
+    state = BoardState()
+    for kind, chan in DUMP_LINE.findall(reply):
+        kind, chan = kind.upper(), int(chan)
+        if chan < 1:
+            continue
+        if kind == "RELAYON":
+            state.relays |= 1 << (chan - 1)
+        elif kind == "IH":
+            state.inputs |= 1 << (chan - 1)
+    return state
+
+
+class IndexedDevice(object):
+    """ A device in the board index, with its channels parsed once. """
+    __slots__ = ("dev", "channel", "zones", "pump_zone")
+
+    def __init__(self, dev):
+        props = dev.pluginProps
+        self.dev = dev
+        try:
+            self.channel = int(props.get("channel", -1))
+        except ValueError:
+            self.channel = -1
+        self.zones = list()
+        self.pump_zone = 0
+        if dev.deviceTypeId == "Sprinkler":
+            num_zones = int(props.get("NumZones", 1))
+            for zone in range(1, num_zones+1):
+                try:
+                    self.zones.append((zone, int(props["zoneRelay"+str(zone)]), dev.zoneNames[zone - 1]))
+                except (KeyError, IndexError, ValueError):
+                    continue
+            if props.get("PumpControlOn", False) is True:
+                self.pump_zone = num_zones
+
+
+def relay_commands(snapshot, desired):
+    """ Returns the (channel, on) commands that move a board from snapshot to the
+    desired relay map, {channel: on}, with offs first. Without a snapshot the
+    current states are unknown, so every relay gets a command. """
+    offs = sorted(chan for chan, state in desired.items()
+                  if not state and (snapshot is None or snapshot.relay(chan)))
+    ons = sorted(chan for chan, state in desired.items()
+                 if state and (snapshot is None or not snapshot.relay(chan)))
+    return [(chan, False) for chan in offs] + [(chan, True) for chan in ons]
+
+
+class CircuitBreaker(object):
+    """ Tracks consecutive failures for one board. While the breaker is open
+    the board is skipped, so a dead board does not use up the full timeout on
+    every polling cycle. The cooldown doubles with each failure. """
+
+    def __init__(self):
+        self.failures = 0
+        self.retry_at = 0
+
+    def ready(self):
+        """ Returns True if the board may be polled now. """
+        return time.time() >= self.retry_at
+
+    def success(self):
+        """ Close the breaker. Returns the number of failures that preceded this success. """
+        failures, self.failures, self.retry_at = self.failures, 0, 0
+        return failures
+
+    def failure(self, cooldown):
+        """ Open the breaker. Returns the number of seconds until the next retry. """
+        self.failures += 1
+        delay = min(cooldown * 2 ** (self.failures - 1), max(cooldown, MAX_RETRY_COOLDOWN))
+        self.retry_at = time.time() + delay
+        return delay
+
+
+class PollScheduler(object):
+    """ A priority queue of boards keyed by the time each one is next due to be
+    polled. Rescheduling a board leaves its old heap entry behind; stale entries
+    are skipped when they come up. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heap = []
+        self._due = dict()
+        self._burst_until = dict()
+        self._last_change = dict()
+
+    def known(self, key):
+        """ Returns True if the board has a poll scheduled. """
+        return key in self._due
+
+    def schedule(self, key, delay):
+        """ Schedule the next poll of a board, delay seconds from now. """
+        with self._lock:
+            when = time.time() + delay
+            self._due[key] = when
+            heapq.heappush(self._heap, (when, key))
+
+    def pop_due(self):
+        """ Removes and returns the boards that are due to be polled. """
+        now, due = time.time(), set()
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                when, key = heapq.heappop(self._heap)
+                if self._due.get(key) == when:
+                    del self._due[key]
+                    due.add(key)
+        return due
+
+    def wait(self):
+        """ Returns the number of seconds until the next board is due. """
+        with self._lock:
+            if not self._heap:
+                return None
+            return max(self._heap[0][0] - time.time(), 0)
+
+    def burst(self, key):
+        """ Poll a board right away, then at the burst interval for a while. """
+        self.changed(key)
+        with self._lock:
+            self._burst_until[key] = time.time() + BURST_DURATION
+        self.schedule(key, 0)
+
+    def changed(self, key):
+        """ Record that something on a board changed, so it is not idle. """
+        self._last_change[key] = time.time()
+
+    def interval(self, key, base, burst, idle=True):
+        """ Returns the poll interval for a board with the given base interval.
+        If idle is True the board slows down after a quiet spell. """
+        now = time.time()
+        if now < self._burst_until.get(key, 0):
+            return min(burst, base)
+        if idle and now - self._last_change.setdefault(key, now) > IDLE_AFTER:
+            return base * IDLE_MULTIPLIER
+        return base
+
+
+class RollingHistogram(object):
+    """ Keeps the most recent latency samples, in milliseconds, in a fixed-size ring. """
+
+    def __init__(self, size=HISTOGRAM_SIZE):
+        self._samples = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, seconds):
+        """ Record one sample. """
+        self._samples.append(seconds * 1000)
+
+    def percentile(self, pct):
+        """ Returns the pct percentile of the recorded samples, or 0 if there are none. """
+        samples = sorted(self._samples)
+        if not samples:
+            return 0
+        return round(samples[int(round(pct / 100.0 * (len(samples) - 1)))], 1)
+
+
+class BoardStats(object):
+    """ Timing and traffic counters for one board's session. """
+    __slots__ = ("connect", "poll", "command", "confirm", "polls", "commands", "bytes_read",
+                 "timeouts", "connects", "reconnects", "idle_reconnects", "errors")
+
+    def __init__(self):
+        self.connect = RollingHistogram()
+        self.poll = RollingHistogram()
+        self.command = RollingHistogram()
+        self.confirm = RollingHistogram()
+        self.polls = self.commands = self.bytes_read = 0
+        self.timeouts = self.connects = self.errors = 0
+        # Sessions replaced because they failed, and sessions replaced because they sat idle too long.
+        self.reconnects = self.idle_reconnects = 0
+
+    def states(self):
+        """ Returns the stats as a list of (state, value) pairs for a Status device. """
+        states = list()
+        for name in ("connect", "poll", "command", "confirm"):
+            histogram = getattr(self, name)
+            for pct in (50, 95, 99):
+                states.append(("{}P{}".format(name, pct), histogram.percentile(pct)))
+        return states + [("polls", self.polls), ("commands", self.commands), ("bytesRead", self.bytes_read),
+                         ("timeouts", self.timeouts), ("reconnects", self.reconnects),
+                         ("idleReconnects", self.idle_reconnects), ("errors", self.errors)]
+
+
+class CommandFuture(object):
+    """ The outcome of a queued command. Callbacks run on the board's command
+    worker once the board replies, the command fails, or a newer command for
+    the same relay replaces it (superseded). """
+
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self.superseded = False
+        self._done = threading.Event()
+        self._callbacks = list()
+        self._lock = threading.Lock()
+
+    def done(self):
+        """ Returns True once the command has been resolved. """
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """ Block until the command is resolved. Returns True if it was. """
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def add_done_callback(self, callback):
+        """ Call callback(future) when the command is resolved, or now if it already is. """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        run_callback(callback, self)
+
+    def resolve(self, result=None, error=None, superseded=False):
+        """ Record the outcome and run the callbacks. """
+        with self._lock:
+            self.result, self.error, self.superseded = result, error, superseded
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, list()
+        for callback in callbacks:
+            run_callback(callback, self)
+
+
+def run_callback(callback, future):
+    """ Run a command callback; an exception in one must not stop the command worker. """
+    try:
+        callback(future)
+    except Exception as err:
+        indigo.server.log(u"Error in relay command callback: {}".format(err), isError=True)
+
+
+class CommandQueue(object):
+    """ An ordered queue of commands for one board, sent by a worker thread so the
+    caller never waits on the network. A command queued with the same merge key as
+    one still waiting replaces it; the older command is resolved as superseded. """
+
+    def __init__(self, name):
+        self._name = name
+        self._pending = list()
+        self._busy = False
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def put(self, func, merge_key=None):
+        """ Queue func() to run on the worker. Returns a CommandFuture for its result. """
+        future = CommandFuture()
+        with self._cond:
+            if merge_key is not None:
+                for item in list(self._pending):
+                    if item[0] == merge_key:
+                        self._pending.remove(item)
+                        item[2].resolve(superseded=True)
+            self._pending.append((merge_key, func, future))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self._name)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+        return future
+
+    def drain(self, timeout=None):
+        """ Block until every queued command has been sent. Returns True if they were. """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._pending or self._busy:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self):
+        """ Stop the worker once it finishes the current command. """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def _run(self):
+        """ Thread target: send queued commands in order. """
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                _, func, future = self._pending.pop(0)
+                self._busy = True
+            try:
+                future.resolve(result=func())
+            except Exception as err:
+                future.resolve(error=err)
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+
+class RelayConnection(object):
+    """ A persistent session with one relay board. Requests hold the lock for
+    the whole write and read, so concurrent actions and polls never interleave
+    bytes on the wire. A dead or idle session is replaced transparently. """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = int(port)
+        self.lock = threading.RLock()
+        self.stats = BoardStats()
+        self._telnet = None
+        self._last_used = 0
+
+    def close(self):
+        """ Close the session; the next request opens a new one. """
+        with self.lock:
+            if self._telnet is not None:
+                self._telnet.close()
+            self._telnet = None
+
+    def _healthy(self):
+        """ Returns True if the open session can be reused. Stale output is discarded. """
+        if self._telnet is None:
+            return False
+        if time.time() - self._last_used > IDLE_TIMEOUT:
+            self.stats.idle_reconnects += 1
+            return False
+        try:
+            self._telnet.read_very_eager()
+        except (socket.error, EOFError):
+            self.stats.reconnects += 1
+            return False
+        return True
+
+    def request(self, line, until, timeout, retry=True):
+        """ Send one line to the board and return its reply, read up to `until`.
+        Raises socket.timeout if `until` does not arrive in time. A request on a
+        reused session that fails is retried once on a new one; with retry=False
+        (pulses) it is only retried if the line was never written. """
+        with self.lock:
+            fresh = False
+            while True:
+                written = False
+                try:
+                    if not self._healthy():
+                        self.close()
+                        fresh = True
+                        self._open(timeout)
+                    start = time.time()
+                    self._telnet.write(line + "\r\n")
+                    written = True
+                    reply = self._telnet.read_until(until, timeout)
+                    if until not in reply:
+                        # Do not leave the rest of a late reply on the wire.
+                        raise socket.timeout(u"no reply to {} in {} seconds".format(line, timeout))
+                except (socket.error, EOFError) as err:
+                    if isinstance(err, socket.timeout):
+                        self.stats.timeouts += 1
+                    if self._telnet is not None:
+                        # The session is lost; the next request opens a new one.
+                        self.stats.reconnects += 1
+                    self.close()
+                    if fresh or (written and not retry):
+                        self.stats.errors += 1
+                        raise
+                    continue
+                self._record(line, reply, time.time() - start)
+                self._last_used = time.time()
+                return reply
+
+    def _open(self, timeout):
+        """ Open a new session and record how long the connect took. """
+        start = time.time()
+        self._telnet = Telnet(self.host, self.port, timeout)
+        self.stats.connect.add(time.time() - start)
+        self.stats.connects += 1
+
+    def _record(self, line, reply, elapsed):
+        """ Record the round trip time and size of one reply. """
+        self.stats.bytes_read += len(reply)
+        if line == "DUMP":
+            self.stats.polls += 1
+            self.stats.poll.add(elapsed)
+        else:
+            self.stats.commands += 1
+            self.stats.command.add(elapsed)
+
+
+class LogWindow(object):
+    """ Event log rate limit state for one device. """
+    __slots__ = ("name", "start", "length", "sent", "suppressed", "last")
+
+    def __init__(self, name, start, length):
+        self.name, self.start, self.length = name, start, length
+        self.sent = self.suppressed = 0
+        self.last = None
+
+
+class EventLog(object):
+    """ Buffers event log messages and writes them from a background thread, so the
+    poll and command threads never wait on the Indigo server. A device may log `limit`
+    messages per window; the rest are counted and summarized when the window closes. """
+
+    def __init__(self, write):
+        self._write = write
+        self._pending = list()
+        self._windows = dict()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def log(self, message, dev=None, window=10, limit=3):
+        """ Queue a message. Messages about a device are rate limited; limit 0 means no limit. """
+        now = time.time()
+        with self._lock:
+            if dev is not None and limit > 0:
+                win = self._windows.get(dev.id)
+                if win is None or now - win.start >= win.length:
+                    if win is not None:
+                        self._summarize(win)
+                    win = self._windows[dev.id] = LogWindow(dev.name, now, window)
+                if win.sent >= limit:
+                    win.suppressed += 1
+                    win.last = message
+                    return
+                win.sent += 1
+            self._pending.append(message)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="Relay Event Log")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def flush(self):
+        """ Write the queued messages and the summaries of any closed windows. """
+        now = time.time()
+        with self._lock:
+            for did, win in self._windows.items():
+                if now - win.start >= win.length:
+                    del self._windows[did]
+                    self._summarize(win)
+            pending, self._pending = self._pending, list()
+        for message in pending:
+            try:
+                self._write(message)
+            except Exception:
+                pass  # The event log is gone while Indigo shuts down.
+
+    def close(self):
+        """ Write everything still buffered, including open windows. """
+        with self._lock:
+            for win in self._windows.values():
+                self._summarize(win)
+            self._windows.clear()
+        self.flush()
+
+    def _summarize(self, win):
+        """ Queue one line for the messages a window held back. Call with the lock held. """
+        if win.suppressed:
+            self._pending.append(u"\"{}\" logged {} more events in {} seconds; last: {}"
+                                 .format(win.name, win.suppressed, win.length, win.last))
+
+    def _run(self):
+        """ Flush the buffer every LOG_FLUSH_INTERVAL seconds. """
+        while True:
+            time.sleep(LOG_FLUSH_INTERVAL)
+            self.flush()
+
 
 class Plugin(indigo.PluginBase):
     """ Indigo Plugin """
@@ -17,6 +547,124 @@ class Plugin(indigo.PluginBase):
         """ Initialize Plugin. """
         indigo.PluginBase.__init__(self, pid, name, version, prefs)
         self.debug = False
+        self._breakers = dict()
+        self._connections = dict()
+        self._connections_lock = threading.Lock()
+        self._queues = dict()
+        self._snapshots = dict()
+        self._update_counts = {"applied": 0, "skipped": 0}
+        self._update_counts_lock = threading.Lock()
+        self._scheduler = PollScheduler()
+        self._index = dict()
+        self._index_lock = threading.Lock()
+        self._index_dirty = False
+        self._edges = dict()
+        self._status_pushed = dict()
+        self._monitors = dict()
+        self._monitors_lock = threading.Lock()
+        self._event_log = EventLog(indigo.server.log)
+        self._poll_jobs = Queue.Queue()
+        self._poll_threads = list()
+        self._polling = dict()
+        self._polling_lock = threading.Lock()
+        self._relay_targets = dict()
+        self._relay_targets_lock = threading.Lock()
+
+    def shutdown(self):
+        """ Close any open board sessions when the plugin stops. """
+        with self._monitors_lock:
+            for _, stop in self._monitors.values():
+                stop.set()
+        for _ in self._poll_threads:
+            self._poll_jobs.put(None)
+        with self._connections_lock:
+            queues, connections = list(self._queues.values()), list(self._connections.values())
+        # Close sessions without _connections_lock; a command may hold a session's lock.
+        for queue in queues:
+            queue.stop()
+        for conn in connections:
+            conn.close()
+        self._event_log.close()
+
+    def deviceStartComm(self, dev):
+        """ Add a device to the board index. """
+        # Devices created by an older version lack newer states, like a Sensor's edgeCount.
+        dev.stateListOrDisplayStateIdChanged()
+        self._index_device(dev)
+
+    def deviceStopComm(self, dev):
+        """ Remove a device from the board index. """
+        with self._index_lock:
+            self._unindex_device(dev.id)
+
+    def deviceUpdated(self, orig_dev, new_dev):
+        """ Keep the indexed copy of a device current. """
+        indigo.PluginBase.deviceUpdated(self, orig_dev, new_dev)
+        with self._index_lock:
+            indexed = any(new_dev.id in devs for devs in self._index.values())
+        if indexed:
+            self._index_device(new_dev)
+
+    def _index_device(self, dev):
+        """ Add or replace a device in the index of (hostname, port) to devices. """
+        with self._index_lock:
+            self._unindex_device(dev.id)
+            key = self._device_board(dev)
+            if key is not None:
+                self._index.setdefault(key, dict())[dev.id] = IndexedDevice(dev)
+                self._schedule_new_board(key)
+
+    def _device_board(self, dev):
+        """ Returns the board key an enabled, configured device belongs in, or None. """
+        if (dev.enabled and dev.configured and "hostname" in dev.pluginProps
+                and "port" in dev.pluginProps):
+            return board_key(dev.pluginProps["hostname"], dev.pluginProps["port"])
+        return None
+
+    def _schedule_new_board(self, key):
+        """ Poll a new or restarted board on the next pass. """
+        if not self._scheduler.known(key):
+            self._scheduler.schedule(key, 0)
+
+    def _unindex_device(self, did):
+        """ Remove a device from the index. Call with the index lock held. """
+        for key, devs in self._index.items():
+            if devs.pop(did, None) is not None and not devs:
+                del self._index[key]
+
+    def _invalidate_index(self):
+        """ Rebuild the device index before the next poll. """
+        self._index_dirty = True
+
+    def _rebuild_index(self):
+        """ Index every enabled plugin device from scratch. The new index is built
+        aside and swapped in at once, so pollers never see it half built. """
+        self._index_dirty = False
+        index = dict()
+        for dev in indigo.devices.iter("self"):
+            key = self._device_board(dev)
+            if key is not None:
+                index.setdefault(key, dict())[dev.id] = IndexedDevice(dev)
+        with self._index_lock:
+            self._index = index
+        for key in index:
+            self._schedule_new_board(key)
+
+    def _connection(self, host, port):
+        """ Returns the shared session for a host/port combo. """
+        with self._connections_lock:
+            key = board_key(host, port)
+            if key not in self._connections:
+                self._connections[key] = RelayConnection(host, port)
+            return self._connections[key]
+
+    def _command_queue(self, host, port):
+        """ Returns the command queue for a host/port combo. """
+        with self._connections_lock:
+            key = board_key(host, port)
+            if key not in self._queues:
+                self._queues[key] = CommandQueue(u"Relay commands {}:{}".format(*key))
+            return self._queues[key]
 
     def validateDeviceConfigUi(self, values, type_id, did):
         """ Validate the config for each sub device is ok. Set address prop. """
@@ -27,8 +675,8 @@ class Plugin(indigo.PluginBase):
             try:
                 channel = int(values["channel"])
             except:
-                channel = 0
-            prefix = "r" if type_id == "Relay" else "i"
+                channel = 0 if type_id != "Status" else ""
+            prefix = {"Relay": "r", "Status": "b"}.get(type_id, "i")
         elif type_id == "Sprinkler":
             prefix = "s"
             channel = ""  # Add all channels here.
@@ -49,6 +697,7 @@ class Plugin(indigo.PluginBase):
             values["ZoneNames"] = zone_names
         values["address"] = u"{} {}{}".format(props.get("hostname", values["address"]), prefix, channel)
         dev.replacePluginPropsOnServer(props)
+        self._invalidate_index()
         return (True, values)
 
 
@@ -100,8 +749,8 @@ class Plugin(indigo.PluginBase):
         for did in dev_id_list:
             dev = indigo.devices[did]
             props = dev.pluginProps
-            channel = props.get("channel", 0)
-            prefix = "r" if dev.deviceTypeId == "Relay" else "i"
+            channel = props.get("channel", 0 if dev.deviceTypeId != "Status" else "")
+            prefix = {"Relay": "r", "Status": "b"}.get(dev.deviceTypeId, "i")
             props["hostname"] = values.get("address", props.get("hostname", ""))
             props["port"] = values.get("port", props.get("port", "1234"))
             props["NumZones"] = values.get("NumZones", props.get("NumZones", "1"))
@@ -116,99 +765,160 @@ class Plugin(indigo.PluginBase):
                     channel += str(props.get("zoneRelay"+str(zone), 0))
             props["address"] = u"{} {}{}".format(props["hostname"], prefix, channel)
             dev.replacePluginPropsOnServer(props)
-        self.set_device_states()
+        self._invalidate_index()
+        self.set_device_states(force=True)
         return values
 
     def runConcurrentThread(self):
         """ Method called by Indigo to poll the relay board(s).
         This is required because the board has no way to send an update to Indigo.
         If the input sensors are tripped we have to poll to get that state change.
+        Each board is polled when its own interval comes due; see _poll_interval.
         """
         try:
+            self._sync_monitors()
+            self.set_device_states()
             while True:
-                self.set_device_states()
-                self.sleep(int(indigo.activePlugin.pluginPrefs.get("interval", 15)))
+                self._sync_monitors()
+                due = self._scheduler.pop_due()
+                if due:
+                    self.set_device_states(keys=due)
+                wait = self._scheduler.wait()
+                # Wake up at least twice a second to pick up bursts and new boards.
+                self.sleep(0.5 if wait is None else min(wait, 0.5))
         except self.StopThread:
             pass
 
+    def _sync_monitors(self):
+        """ Start an input monitor for each board with input sensors when the
+        monitorInputs pref is on, and stop monitors that are no longer needed. """
+        wanted = set()
+        if self.pluginPrefs.get("monitorInputs", False):
+            with self._index_lock:
+                wanted = set(key for key, devs in self._index.items()
+                             if any(entry.dev.deviceTypeId == "Sensor" for entry in devs.values()))
+        with self._monitors_lock:
+            for key in set(self._monitors) - wanted:
+                self._monitors.pop(key)[1].set()
+            for key in wanted - set(self._monitors):
+                stop = threading.Event()
+                thread = threading.Thread(target=self._monitor_board, args=(key, stop),
+                                          name=u"Input monitor {}:{}".format(*key))
+                thread.daemon = True
+                self._monitors[key] = (thread, stop)
+                thread.start()
+
+    def _monitor_board(self, key, stop):
+        """ Thread target: poll one board in a tight loop over its persistent session
+        so input changes reach Indigo within a fraction of a second. The board has
+        no way to push changes, so this is as close to event-driven as it gets. """
+        while not stop.is_set():
+            start = time.time()
+            with self._index_lock:
+                devs = list(self._index.get(key, dict()).values())
+            try:
+                self._poll_board(key[0], key[1], devs)
+            except Exception as err:
+                indigo.server.log(u"Error monitoring relay board {}:{}: {}".format(key[0], key[1], err), isError=True)
+            interval = float(self.pluginPrefs.get("monitorInterval", 0.25))
+            stop.wait(max(interval - (time.time() - start), 0))
+
     def actionControlUniversal(self, action, dev):
         """ Contral Misc. Actions here, like requesting a status update. """
         if action.deviceAction == indigo.kUniversalAction.RequestStatus:
-            self.set_device_states()
+            # Poll only this device's board, after any commands already queued for it.
+            host, port = dev.pluginProps.get("hostname"), dev.pluginProps.get("port")
+            if host and port:
+                key = board_key(host, port)
+                self._command_queue(host, port).put(lambda: self.set_device_states(force=True, keys=set([key])))
 
     def actionControlDevice(self, action, dev):
-        """ Callback Method to Control a Relay Device. """
+        """ Callback Method to Control a Relay Device. Commands are queued; the
+        device state is set once the board replies. """
         if action.deviceAction == indigo.kDeviceAction.TurnOn:
-            try:
-                self.send_cmd(dev.pluginProps, u"L")
-            except (socket.error, EOFError) as err:
-                dev.setErrorStateOnServer(u"Error turning on relay device: {}".format(err))
-            except KeyError:
-                dev.setErrorStateOnServer(u"Relay Channel Missing! Configure Device Settings.")
-            else:
-                dev.updateStateOnServer("onOffState", True)
-                if dev.pluginProps.get("logActions", True):
-                    indigo.server.log(u"Sent \"{}\" on".format(dev.name))
+            self._relay_action(dev, u"L", True, u"Error turning on relay device")
         elif action.deviceAction == indigo.kDeviceAction.TurnOff:
-            try:
-                self.send_cmd(dev.pluginProps, u"D")
-            except (socket.error, EOFError) as err:
-                dev.setErrorStateOnServer(u"Error turning off relay device: {}".format(err))
-            except KeyError:
-                dev.setErrorStateOnServer(u"Relay Channel Missing! Configure Device Settings.")
-            else:
-                dev.updateStateOnServer("onOffState", False)
-                if dev.pluginProps.get("logActions", True):
-                    indigo.server.log(u"Sent \"{}\" off".format(dev.name))
+            self._relay_action(dev, u"D", False, u"Error turning off relay device")
         elif action.deviceAction == indigo.kDeviceAction.Toggle:
-            command, reply, state = (u"L", "on", True)
-            if dev.states["onOffState"]:
-                command, reply, state = (u"D", "off", False)
-            try:
-                self.send_cmd(dev.pluginProps, command)
-            except (socket.error, EOFError) as err:
-                dev.setErrorStateOnServer("Error toggling relay device: {}".format(err))
-            except KeyError:
-                dev.setErrorStateOnServer(u"Relay Channel Missing! Configure Device Settings.")
-            else:
-                dev.updateStateOnServer("onOffState", state)
-                if dev.pluginProps.get("logActions", True):
-                    indigo.server.log(u"Sent \"{}\" {}".format(dev.name, reply))
+            command, state = (u"L", True)
+            if self._relay_target(dev):
+                command, state = (u"D", False)
+            self._relay_action(dev, command, state, u"Error toggling relay device")
+
+    def _relay_target(self, dev):
+        """ Returns the state a relay device is headed for: the state its last queued
+        command leaves it in if that has not finished yet, otherwise its current state. """
+        props = dev.pluginProps
+        try:
+            target = (board_key(props["hostname"], props["port"]), int(props["channel"]))
+        except (KeyError, ValueError):
+            return dev.states["onOffState"]
+        with self._relay_targets_lock:
+            if target in self._relay_targets:
+                return self._relay_targets[target][0]
+        return dev.states["onOffState"]
+
+    def _relay_action(self, dev, command, state, error):
+        """ Queue an on or off command for a relay device and update it when the board replies. """
+        def done(future):
+            if future.superseded:
+                return
+            if future.error is not None:
+                dev.setErrorStateOnServer(u"{}: {}".format(error, future.error))
+                return
+            self._update_states(dev, [("onOffState", state)])
+            if dev.pluginProps.get("logActions", True):
+                confirmed = u""
+                if future.result is not None:
+                    confirmed = u" (confirmed in {:.0f} ms)".format(future.result * 1000)
+                self._log(u"Sent \"{}\" {}{}".format(dev.name, "on" if state else "off", confirmed), dev)
+        try:
+            self.queue_cmd(dev.pluginProps, command).add_done_callback(done)
+        except KeyError:
+            dev.setErrorStateOnServer(u"Relay Channel Missing! Configure Device Settings.")
 
     def actionControlSprinkler(self, action, dev):
-        """ Control sprinklers! """
+        """ Control sprinklers! Every zone on the board is switched in one queued batch. """
+        props = dev.pluginProps
+        num_zones = int(props["NumZones"])
         az = 0
-        for zone in range(1, int(dev.pluginProps["NumZones"])+1):
+        desired, names = dict(), dict()
+        for zone in range(1, num_zones+1):
+            name = dev.zoneNames[zone - 1]
             try:
-                zone_info = {
-                    "hostname": dev.pluginProps["hostname"],
-                    "channel": dev.pluginProps["zoneRelay"+str(zone)],
-                    "port": dev.pluginProps["port"],
-                }
-                cmd, reply, name = u"D", "off", dev.zoneNames[zone - 1]
-                if action.sprinklerAction == indigo.kSprinklerAction.ZoneOn:
-                    if zone == action.zoneIndex:
-                        cmd, reply, az = u"L", "on", zone
-                    if zone == int(dev.pluginProps["NumZones"]) and dev.pluginProps["PumpControlOn"]:
-                        # Turn on the pump too.
-                        cmd, reply = u"L", "on"
-                self.send_cmd(zone_info, cmd)
-            except (socket.error, EOFError) as err:
-                dev.setErrorStateOnServer(u"Error turning {} sprinkler relay zone {} {}: {}"
-                                          .format(reply, zone, name, err))
-                return
+                chan = int(props["zoneRelay"+str(zone)])
             except KeyError:
                 dev.setErrorStateOnServer(u"Sprinkler relay channel missing for zone {} {}! Configure device settings."
                                           .format(zone, name))
                 continue
-            if dev.pluginProps.get("logActions", True):
-                indigo.server.log(u"Sent \"{} - {}\" {}".format(dev.name, name, reply))
-        dev.updateStateOnServer("unexpectedZone", "None")
-        dev.updateStateOnServer("scheduleRunning", False if az == 0 else True)
-        dev.updateStateOnServer("activeZone", az)
-        if az != 0:
-            dev.updateStateOnServer("lastActiveZone", az)
-            dev.updateStateOnServer("lastActiveTime", datetime.now().strftime("%m/%d/%y %H:%M:%S"))
+            state = False
+            if action.sprinklerAction == indigo.kSprinklerAction.ZoneOn:
+                if zone == action.zoneIndex:
+                    state, az = True, zone
+                if zone == num_zones and props["PumpControlOn"]:
+                    # Turn on the pump too.
+                    state = True
+            desired[chan] = desired.get(chan, False) or state
+            names[chan] = name
+
+        def done(future):
+            if future.superseded:
+                return
+            if future.error is not None:
+                dev.setErrorStateOnServer(u"Error switching sprinkler relay zones: {}".format(future.error))
+                return
+            if props.get("logActions", True):
+                for chan, state in future.result:
+                    self._log(u"Sent \"{} - {}\" {}".format(dev.name, names[chan], "on" if state else "off"), dev)
+            states = [("unexpectedZone", "None"), ("scheduleRunning", az != 0), ("activeZone", az)]
+            if az != 0:
+                states += [("lastActiveZone", az), ("lastActiveTime", datetime.now().strftime("%m/%d/%y %H:%M:%S"))]
+            self._update_states(dev, states)
+        # A newer zone change for this sprinkler replaces one that has not been sent yet.
+        queue = self._command_queue(props["hostname"], props["port"])
+        confirm = self.pluginPrefs.get("confirmCommands", False)
+        queue.put(lambda: self.send_relay_batch(props["hostname"], props["port"], desired, confirm),
+                  ("Sprinkler", dev.id)).add_done_callback(done)
 
     def _change_factory_device_type(self, values, dev_id_list):
         """ Devices.xml Callback Method to make sure changing the factory device type is safe. """
@@ -259,6 +969,15 @@ class Plugin(indigo.PluginBase):
         values["createdDevices"] += ","+str(dev.id) if values["createdDevices"] != "" else str(dev.id)
         return values
 
+    def _add_status(self, values, dev_id_list):
+        """ Devices.xml Callback Method to add a new board Status sub-device. """
+        dev = indigo.device.create(indigo.kProtocol.Plugin, deviceTypeId="Status")
+        dev.model = u"8 Channel Network Relay Board"
+        dev.subModel = u"Status"
+        dev.replaceOnServer()
+        values["createdDevices"] += ","+str(dev.id) if values["createdDevices"] != "" else str(dev.id)
+        return values
+
     def _add_sprinkler(self, values, dev_id_list):
         """ Devices.xml Callback Method to add a new Sprinkler sub-device. """
         dev = indigo.device.create(indigo.kProtocol.Plugin, deviceTypeId="Sprinkler")
@@ -278,18 +997,92 @@ class Plugin(indigo.PluginBase):
 
     def _pulse_relay(self, action, dev):
         """ Actions.xml Callback Method to pulse a relay. """
+        def done(future):
+            if future.error is not None:
+                dev.setErrorStateOnServer("Error Pulsing Relay: {}".format(future.error))
+                return
+            if dev.pluginProps.get("logActions", True):
+                self._log(u"Sent \"{}\" relay pulse".format(dev.name), dev)
+            self._update_states(dev, [("pulseCount", dev.states.get("pulseCount", 0) + 1),
+                                      ("pulseTimestamp", datetime.now().strftime("%s")),
+                                      ("onOffState", False)])  # Pulse always turns off.
         try:
-            self.send_cmd(dev.pluginProps, u"P")
-        except (socket.error, EOFError) as err:
-            dev.setErrorStateOnServer("Error Pulsing Relay: {}".format(err))
+            self.queue_cmd(dev.pluginProps, u"P").add_done_callback(done)
         except KeyError:
             dev.setErrorStateOnServer(u"Relay Channel Missing! Configure Device Settings.")
-        else:
-            if dev.pluginProps.get("logActions", True):
-                indigo.server.log(u"Sent \"{}\" relay pulse".format(dev.name))
-            dev.updateStateOnServer("pulseCount", dev.states.get("pulseCount", 0) + 1)
-            dev.updateStateOnServer("pulseTimestamp", datetime.now().strftime("%s"))
-            dev.updateStateOnServer("onOffState", False)  # Pulse always turns off.
+
+    def validateActionConfigUi(self, values, type_id, did):
+        """ Make sure a relay group action has at least one relay. """
+        errors = indigo.Dict()
+        if type_id == "groupControl" and not values.get("relayDevices"):
+            errors["relayDevices"] = u"Select at least one relay device."
+        if errors:
+            return (False, values, errors)
+        return (True, values)
+
+    def _group_control(self, action):
+        """ Actions.xml Callback Method to switch a group of relays on any number of boards.
+        Each board's relays are queued as one batch on that board's command queue, so
+        every board is switched at the same time. Logs the time each board took. """
+        target = action.props.get("groupState", "on")
+        boards = dict()
+        for did in action.props.get("relayDevices", list()):
+            try:
+                dev = indigo.devices[int(did)]
+            except (KeyError, ValueError):
+                indigo.server.log(u"Relay group: device {} no longer exists, skipping it".format(did), isError=True)
+                continue
+            if not dev.enabled:
+                self._log(u"Relay group: device \"{}\" is disabled, skipping it".format(dev.name))
+                continue
+            props = dev.pluginProps
+            try:
+                key = board_key(props["hostname"], props["port"])
+                boards.setdefault(key, list()).append((dev, int(props["channel"])))
+            except (KeyError, ValueError):
+                dev.setErrorStateOnServer(u"Relay Channel Missing! Configure Device Settings.")
+        start = time.time()
+        remaining = [len(boards)]
+        failed = list()
+        lock = threading.Lock()
+
+        def finished(key, members):
+            def done(future):
+                elapsed = (time.time() - start) * 1000
+                if future.error is not None:
+                    for dev, _ in members:
+                        dev.setErrorStateOnServer(u"Error switching relay group: {}".format(future.error))
+                    indigo.server.log(u"Relay group: board {}:{} failed after {:.0f} ms: {}"
+                                      .format(key[0], key[1], elapsed, future.error), isError=True)
+                else:
+                    for dev, _ in members:
+                        states = [("onOffState", target == "on")]
+                        if target == "pulse":
+                            states += [("pulseCount", dev.states.get("pulseCount", 0) + 1),
+                                       ("pulseTimestamp", datetime.now().strftime("%s"))]
+                        self._update_states(dev, states)
+                    verb = u"pulsed" if target == "pulse" else u"turned " + target
+                    self._log(u"Relay group: board {}:{} {} {} relay(s) in {:.0f} ms"
+                              .format(key[0], key[1], verb, len(members), elapsed))
+                with lock:
+                    if future.error is not None:
+                        failed.append(key)
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    self._log(u"Relay group: {} board(s) finished in {:.0f} ms, {} failed"
+                              .format(len(boards), elapsed, len(failed)))
+            return done
+
+        confirm = self.pluginPrefs.get("confirmCommands", False)
+        for key, members in boards.items():
+            channels = [chan for _, chan in members]
+            if target == "pulse":
+                send = lambda key=key, channels=channels: self.send_pulse_batch(key[0], key[1], channels)
+            else:
+                desired = dict((chan, target == "on") for chan in channels)
+                send = lambda key=key, desired=desired: self.send_relay_batch(key[0], key[1], desired, confirm)
+            self._command_queue(*key).put(send).add_done_callback(finished(key, members))
 
     def _reset_pulse_count(self, action, dev):
         """ Set the pulse count for a device back to zero. """
@@ -299,97 +1092,372 @@ class Plugin(indigo.PluginBase):
         """ Set the pulse count for a device back to zero. """
         indigo.devices[did].updateStateOnServer("pulseCount", 0)
 
-    @staticmethod
-    def set_device_states():
-        """ Updates Indigo with current devices" states. """
-        devs = list()
-        hosts = list()
-        # Build two lists: host/port combos, and (sub)devices.
-        for dev in indigo.devices.iter("self"):
-            if (dev.enabled and dev.configured and "hostname" in dev.pluginProps
-                    and "port" in dev.pluginProps):
-                # Make a list of the plugin"s devices and a set of their hostnames.
-                hosts.append((dev.pluginProps["hostname"], dev.pluginProps["port"]))
-                devs.append(dev)
-
-        # Loop each unique host/port combo and poll it for status, then update its devices.
-        for host, port in set(hosts):
-            timeout = int(indigo.activePlugin.pluginPrefs.get("timeout", 4))
-            try:
-                relay = Telnet(host, int(port), timeout)
-                relay.write("DUMP\r\n")
-                statuses = relay.read_until("OK", timeout).upper()
-                relay.close()
-            except (socket.error, EOFError, UnicodeError) as err:
-                for dev in devs:
-                    # Update all the sub devices that failed to get queried.
-                    if (dev.pluginProps["hostname"], dev.pluginProps["port"]) == (host, port):
-                        dev.setErrorStateOnServer(u"Relay Communication Error: {} ({}:{}/{})"
-                                                  .format(err, host, port, timeout))
+    def set_device_states(self, force=False, keys=None, wait=False):
+        """ Updates Indigo with current devices" states.
+        Only the boards in keys are polled if keys is given.
+        Boards with an open circuit breaker are skipped unless force is True, and
+        boards with an input monitor are left to it.
+        The polls run on the poll worker pool; a board that is already being polled
+        is not polled again. With wait, returns once every board has been polled. """
+        if self._index_dirty:
+            self._rebuild_index()
+        with self._index_lock:
+            boards = dict((key, list(devs.values())) for key, devs in self._index.items()
+                          if keys is None or key in keys)
+        # Boards with an input monitor are polled by it alone; two pollers would race the snapshot.
+        with self._monitors_lock:
+            monitored = set(self._monitors)
+        for key in set(boards) & monitored:
+            self._scheduler.schedule(key, self._poll_interval(key, boards.pop(key)))
+        if not boards:
+            return
+
+        # Poll the boards in parallel so one slow board never holds up the others.
+        self._start_poll_workers()
+        polls = list()
+        with self._polling_lock:
+            for key, devs in boards.items():
+                if key not in self._polling:
+                    self._polling[key] = threading.Event()
+                    self._poll_jobs.put((key, devs, force))
+                polls.append(self._polling[key])
+        if wait:
+            for poll in polls:
+                poll.wait()
+
+    def _start_poll_workers(self):
+        """ Start poll worker threads until there are as many as the pollThreads pref. """
+        while len(self._poll_threads) < max(int(self.pluginPrefs.get("pollThreads", 8)), 1):
+            thread = threading.Thread(target=self._poll_worker, name=u"Relay poller")
+            thread.daemon = True
+            self._poll_threads.append(thread)
+            thread.start()
+
+    def _poll_worker(self):
+        """ Thread target: poll boards from the job queue until the plugin shuts down. """
+        while True:
+            job = self._poll_jobs.get()
+            if job is None:
                 return
+            (host, port), devs, force = job
+            try:
+                self._poll_board(host, port, devs, force)
+            except Exception as err:
+                # Never let one board take down the rest of the polling cycle.
+                indigo.server.log(u"Error updating relay board {}:{}: {}".format(host, port, err), isError=True)
+            self._scheduler.schedule((host, port), self._poll_interval((host, port), devs))
+            with self._polling_lock:
+                self._polling.pop((host, port)).set()
 
-            # Update all the devices that belong to this hostname/port.
-            for dev in devs:
-                chan = dev.pluginProps.get("channel", -1)
-                if (dev.pluginProps["hostname"], dev.pluginProps["port"]) != (host, port):
-                    # Device does not match, carry on.
-                    continue
-                if dev.deviceTypeId == "Relay":
-                    state = True if statuses.find("RELAYON {}".format(chan)) != -1 else False
-                elif dev.deviceTypeId == "Sensor":
-                    state = True if statuses.find("IH {}".format(chan)) != -1 else False
-                if dev.deviceTypeId != "Sprinkler":
-                    if dev.pluginProps.get("logChanges", True):
-                        if dev.states["onOffState"] != state:
-                            reply = "on" if state else "off"
-                            indigo.server.log(u"Device \"{}\" turned {}"
-                                              .format(dev.name, reply))
-                    dev.updateStateOnServer("onOffState", state)
+    def _poll_interval(self, key, devs):
+        """ Returns the number of seconds until a board should be polled again.
+        Boards with input sensors use the input interval, others the normal interval.
+        Boards with recent activity are polled at the burst interval and relay-only
+        boards without changes slow down. """
+        burst = float(self.pluginPrefs.get("burstInterval", 1))
+        if any(entry.dev.deviceTypeId == "Sensor" for entry in devs):
+            return self._scheduler.interval(key, float(self.pluginPrefs.get("inputInterval", 5)), burst, idle=False)
+        return self._scheduler.interval(key, float(self.pluginPrefs.get("interval", 15)), burst)
+
+    def _poll_board(self, host, port, devs, force=False):
+        """ Poll one board for status, then update its devices (IndexedDevice entries). """
+        timeout = int(self.pluginPrefs.get("timeout", 4))
+        key = board_key(host, port)
+        breaker = self._breakers.setdefault(key, CircuitBreaker())
+        if not force and not breaker.ready():
+            return
+        try:
+            snapshot = parse_dump(self._connection(host, port).request("DUMP", "OK", timeout))
+        except (socket.error, EOFError, ValueError) as err:
+            stats = self._connection(host, port).stats
+            for entry in devs:
+                if entry.dev.deviceTypeId == "Status":
+                    self._update_states(entry.dev, stats.states())
                     continue
+                # Update all the sub devices that failed to get queried.
+                entry.dev.setErrorStateOnServer(u"Relay Communication Error: {} ({}:{}/{})"
+                                                .format(err, host, port, timeout))
+            # The relays may change while the board is unreachable; batches must not trust the old snapshot.
+            self._snapshots.pop(key, None)
+            delay = breaker.failure(int(self.pluginPrefs.get("retryCooldown", 30)))
+            self._log(u"Relay board {}:{} failed {} time(s), retrying in {} seconds"
+                      .format(host, port, breaker.failures, delay))
+            return
+        if breaker.success() > 0:
+            self._log(u"Relay board {}:{} is responding again".format(host, port))
+        previous = self._snapshots.get(key)
+        self._snapshots[key] = snapshot
+        if previous is not None and previous.inputs != snapshot.inputs:
+            self._count_edges(key, previous.inputs ^ snapshot.inputs)
+            with self._monitors_lock:
+                monitored = key in self._monitors
+            if not monitored:
+                self._scheduler.burst(key)
+        elif previous is not None and previous.relays != snapshot.relays:
+            self._scheduler.changed(key)
+        push_status = time.time() - self._status_pushed.get(key, 0) >= STATUS_INTERVAL
+        if push_status:
+            self._status_pushed[key] = time.time()
+
+        # Update all the devices that belong to this hostname/port.
+        for entry in devs:
+            dev = entry.dev
+            if dev.errorState:
+                dev.setErrorStateOnServer(None)
+            if dev.deviceTypeId == "Status":
+                if push_status:
+                    self._update_states(dev, self._connection(host, port).stats.states())
+                continue
+            if dev.deviceTypeId == "Relay":
+                state = snapshot.relay(entry.channel)
+            elif dev.deviceTypeId == "Sensor":
+                state = snapshot.input(entry.channel)
+            if dev.deviceTypeId != "Sprinkler":
+                if dev.pluginProps.get("logChanges", True):
+                    if dev.states["onOffState"] != state:
+                        reply = "on" if state else "off"
+                        self._log(u"Device \"{}\" turned {}".format(dev.name, reply), dev)
+                states = [("onOffState", state)]
+                if dev.deviceTypeId == "Sensor" and entry.channel in self._edges.get(key, dict()):
+                    count, changed = self._edges[key][entry.channel]
+                    states += [("edgeCount", count), ("lastChange", changed)]
+                self._update_states(dev, states)
+                continue
+
+            # Check if a sprinkler zone turned on or off unexpectedly!
+            active_zone = int(dev.states["activeZone"])
+            now_active = active_zone
+            unexpected = dev.states.get("unexpectedZone", "None")
+            for zone, chan, name in entry.zones:
+                # match the relay to a zone and update state & log
+                state = snapshot.relay(chan)
+                if active_zone != zone and state is True and zone != entry.pump_zone:
+                    self._log(u"Zone \"{} - {}\" unexpectedly turned on".format(dev.name, name), dev)
+                    unexpected = name
+                    now_active = zone
+                if (active_zone == zone and state is False or
+                        (zone == entry.pump_zone and active_zone != 0 and state is False)):
+                    self._log(u"Zone \"{} - {}\" unexpectedly turned off".format(dev.name, name), dev)
+                    now_active = 0
+            states = [("activeZone", now_active)]
+            if now_active == 0:
+                states.append(("unexpectedZone", "None"))
+            else:
+                states.append(("unexpectedZone", unexpected))
+                if now_active != active_zone:
+                    states.append(("lastActiveZone", now_active))
+                    states.append(("lastActiveTime", datetime.now().strftime("%m/%d/%y %H:%M:%S")))
+            self._update_states(dev, states)
+
+    def _count_edges(self, key, changed):
+        """ Count a change on each input in the changed bitmask and record when it happened. """
+        now = datetime.now().strftime("%m/%d/%y %H:%M:%S.%f")[:-3]
+        edges = self._edges.setdefault(key, dict())
+        chan = 1
+        while changed:
+            if changed & 1:
+                edges[chan] = (edges.get(chan, (0, None))[0] + 1, now)
+            changed >>= 1
+            chan += 1
+
+    def _update_states(self, dev, states):
+        """ Sends only the states that changed to the Indigo server, in one call.
+        states is a list of (key, value) pairs. """
+        changes = [{"key": key, "value": value} for key, value in states if dev.states.get(key) != value]
+        with self._update_counts_lock:
+            self._update_counts["applied"] += len(changes)
+            self._update_counts["skipped"] += len(states) - len(changes)
+        if changes:
+            dev.updateStatesOnServer(changes)
+
+    def _log(self, message, dev=None):
+        """ Queue an event log message; messages about a device are rate limited per the plugin prefs. """
+        window = int(self.pluginPrefs.get("logWindow", 10))
+        limit = int(self.pluginPrefs.get("logLimit", 3))
+        self._event_log.log(message, dev, window, limit)
+
+    def _log_update_counts(self):
+        """ MenuItems.xml Callback Method to log how many state updates were sent or skipped. """
+        with self._update_counts_lock:
+            counts = dict(self._update_counts)
+        indigo.server.log(u"Device state updates: {} applied, {} skipped (unchanged)"
+                          .format(counts["applied"], counts["skipped"]))
+
+    def _log_board_stats(self):
+        """ MenuItems.xml Callback Method to log timing and traffic stats for every board. """
+        with self._connections_lock:
+            connections = sorted(self._connections.items())
+        for (host, port), conn in connections:
+            stats = conn.stats
+            indigo.server.log(u"Relay board {}:{}: {} polls, {} commands, {} bytes read, {} timeouts, "
+                              u"{} reconnects after failures, {} idle reconnects, {} errors"
+                              .format(host, port, stats.polls, stats.commands, stats.bytes_read, stats.timeouts,
+                                      stats.reconnects, stats.idle_reconnects, stats.errors))
+            for name in ("connect", "poll", "command", "confirm"):
+                histogram = getattr(stats, name)
+                indigo.server.log(u"    {:8} ms: p50 {}, p95 {}, p99 {} ({} samples)"
+                                  .format(name, histogram.percentile(50), histogram.percentile(95),
+                                          histogram.percentile(99), len(histogram)))
+        if not connections:
+            indigo.server.log(u"No relay boards have been contacted yet")
+
+    def send_cmd(self, values, cmd):
+        """ Sends a simple command to the relay board and returns its reply. """
+        timeout = self.pluginPrefs.get("timeout", 4)
+        line = "{}{}".format(cmd, values["channel"])
+        key = board_key(values["hostname"], values["port"])
+        try:
+            reply = self._connection(values["hostname"], values["port"]).request(line, "\n", int(timeout), cmd != u"P")
+        except (socket.error, EOFError) as err:
+            self._command_failed(key, err, timeout)
+            raise
+        self._command_sent(key)
+        self._scheduler.burst(key)
+        snapshot = self._snapshots.get(key)
+        if snapshot is not None:
+            # A pulse always ends with the relay off.
+            snapshot.set_relay(int(values["channel"]), cmd == u"L")
+        return reply
 
-                # Check if a sprinkler zone turned on or off unexpectedly!
-                active_zone = int(dev.states["activeZone"])
-                now_active = active_zone
-                for zone in range(1, int(dev.pluginProps["NumZones"])+1):
-                    try:
-                        chan = dev.pluginProps["zoneRelay"+str(zone)]
-                        name = dev.zoneNames[zone - 1]
-                    except KeyError:
-                        continue
-                    # match the relay to a zone and update state & log
-                    state = True if statuses.find("RELAYON {}".format(chan)) != -1 else False
-                    if (active_zone != zone and state is True and
-                            (dev.pluginProps["PumpControlOn"] is False
-                             or zone != int(dev.pluginProps["NumZones"]))):
-                        indigo.server.log(u"Zone \"{} - {}\" unexpectedly turned on"
-                                          .format(dev.name, name))
-                        dev.updateStateOnServer("unexpectedZone", name)
-                        now_active = zone
-                    if (active_zone == zone and state is False or
-                            (dev.pluginProps["PumpControlOn"] is True
-                             and zone == int(dev.pluginProps["NumZones"])
-                             and active_zone != 0)):
-                        indigo.server.log(u"Zone \"{} - {}\" unexpectedly turned off"
-                                          .format(dev.name, name))
-                        now_active = 0
-                if now_active == 0:
-                    dev.updateStateOnServer("unexpectedZone", "None")
+    def confirm_cmd(self, values, cmd):
+        """ Sends an on (L) or off (D) command, then reads the relay back on the same
+        session. The command is resent up to CONFIRM_RETRIES times until the board
+        reports the wanted state. Returns the seconds from the first send to the
+        confirming read. Raises ConfirmError if the relay never switches. """
+        chan, state = int(values["channel"]), cmd == u"L"
+        timeout = int(self.pluginPrefs.get("timeout", 4))
+        key = board_key(values["hostname"], values["port"])
+        # Look the session up before taking its lock; shutdown takes the locks the other way round.
+        conn = self._connection(values["hostname"], values["port"])
+        start = time.time()
+        try:
+            with conn.lock:
+                for _ in range(CONFIRM_RETRIES + 1):
+                    self._send_relays(conn, key, [(chan, state)], timeout)
+                    if self.read_relay(conn, key, chan, timeout) == state:
+                        latency = time.time() - start
+                        conn.stats.confirm.add(latency)
+                        break
                 else:
-                    dev.updateStateOnServer("lastActiveZone", now_active)
-                    dev.updateStateOnServer("lastActiveTime", datetime.now().strftime("%m/%d/%y %H:%M:%S"))
+                    raise ConfirmError(u"relay {} did not turn {} after {} tries"
+                                       .format(chan, "on" if state else "off", CONFIRM_RETRIES + 1))
+        except (socket.error, EOFError) as err:
+            self._command_failed(key, err, timeout)
+            raise
+        self._command_sent(key)
+        self._scheduler.burst(key)
+        return latency
+
+    def read_relay(self, conn, key, chan, timeout):
+        """ Reads one relay's state with R(n) on a board session. Returns True if it is on. """
+        reply = conn.request("R{}".format(chan), "\n", timeout)
+        match = DUMP_LINE.search(reply)
+        if match is None or int(match.group(2)) != chan or match.group(1).upper() not in ("RELAYON", "RELAYOFF"):
+            raise ValueError(u"unexpected reply to relay read: {!r}".format(reply))
+        state = match.group(1).upper() == "RELAYON"
+        snapshot = self._snapshots.get(key)
+        if snapshot is not None:
+            snapshot.set_relay(chan, state)
+        return state
+
+    def queue_cmd(self, values, cmd):
+        """ Queues a simple command for the relay board and returns a CommandFuture.
+        An on or off command replaces an on or off for the same relay that has not
+        been sent yet. Pulses are never merged. Raises KeyError if there is no channel.
+        With the confirmCommands pref on, on and off commands are read back and the
+        future's result is the confirm latency in seconds; otherwise it is None. """
+        chan = int(values["channel"])
+        merge_key = chan if cmd in (u"L", u"D") else None
+        confirm = merge_key is not None and self.pluginPrefs.get("confirmCommands", False)
+
+        def send():
+            if confirm:
+                return self.confirm_cmd(values, cmd)
+            self.send_cmd(values, cmd)
+        future = self._command_queue(values["hostname"], values["port"]).put(send, merge_key)
+        # Remember where the relay is headed until the command finishes, so a toggle
+        # queued behind it goes the right way. A pulse always leaves the relay off.
+        target = (board_key(values["hostname"], values["port"]), chan)
+        with self._relay_targets_lock:
+            self._relay_targets[target] = (cmd == u"L", future)
+        future.add_done_callback(lambda done: self._clear_relay_target(target, done))
+        return future
 
-                dev.updateStateOnServer("activeZone", now_active)
+    def _clear_relay_target(self, target, future):
+        """ Forget a relay's queued state once the command that set it is done. """
+        with self._relay_targets_lock:
+            if self._relay_targets.get(target, (None, None))[1] is future:
+                del self._relay_targets[target]
 
+    def send_relay_batch(self, host, port, desired, confirm=False):
+        """ Applies a desired relay map, {channel: on}, to one board in one session.
+        Relays already in the desired state (per the last DUMP) get no command, and
+        off commands go out before on commands. With confirm, the board is read back
+        with DUMP and any relay that did not switch is resent, up to CONFIRM_RETRIES
+        times. Returns the (channel, on) pairs sent the first time. """
+        timeout = int(self.pluginPrefs.get("timeout", 4))
+        key = board_key(host, port)
+        conn = self._connection(host, port)
+        start = time.time()
+        try:
+            with conn.lock:
+                batch = self._send_relays(conn, key, relay_commands(self._snapshots.get(key), desired), timeout)
+                for retry in (range(CONFIRM_RETRIES + 1) if confirm else []):
+                    snapshot = parse_dump(conn.request("DUMP", "OK", timeout))
+                    self._snapshots[key] = snapshot
+                    missed = relay_commands(snapshot, desired)
+                    if not missed:
+                        conn.stats.confirm.add(time.time() - start)
+                        break
+                    if retry == CONFIRM_RETRIES:
+                        raise ConfirmError(u"relays {} did not switch after {} tries"
+                                           .format(", ".join(str(chan) for chan, _ in missed), retry + 1))
+                    self._send_relays(conn, key, missed, timeout)
+        except (socket.error, EOFError) as err:
+            self._command_failed(key, err, timeout)
+            raise
+        if batch:
+            self._command_sent(key)
+            self._scheduler.burst(key)
+        return batch
 
-    @staticmethod
-    def send_cmd(values, cmd):
-        """ Sends a simple command to the relay board. """
-        timeout = indigo.activePlugin.pluginPrefs.get("timeout", 4)
+    def send_pulse_batch(self, host, port, channels):
+        """ Pulses a list of relay channels on one board in one session. """
+        timeout = int(self.pluginPrefs.get("timeout", 4))
+        key = board_key(host, port)
+        conn = self._connection(host, port)
+        snapshot = self._snapshots.get(key)
         try:
-            relay = Telnet(values["hostname"], int(values["port"]), int(timeout))
-            relay.write("{}{}\r\n".format(cmd, values["channel"]))
-            relay.close()
+            with conn.lock:
+                for chan in channels:
+                    conn.request("P{}".format(chan), "\n", timeout, retry=False)
+                    if snapshot is not None:
+                        snapshot.set_relay(chan, False)
         except (socket.error, EOFError) as err:
-            indigo.server.log(u"Relay Communication Error: {} ({}:{}/{})"
-                              .format(err, values["hostname"], values["port"], timeout))
+            self._command_failed(key, err, timeout)
             raise
+        self._command_sent(key)
+        self._scheduler.burst(key)
+        return channels
+
+    def _command_failed(self, key, err, timeout):
+        """ Log a failed command and drop the board's snapshot, so the next batch
+        sends every relay instead of trusting states the board may have lost. """
+        self._snapshots.pop(key, None)
+        self._log(u"Relay Communication Error: {} ({}:{}/{})".format(err, key[0], key[1], timeout))
+
+    def _command_sent(self, key):
+        """ A board that answered a command is back: close its breaker so it is polled again. """
+        breaker = self._breakers.get(key)
+        if breaker is not None and breaker.success() > 0:
+            self._log(u"Relay board {}:{} is responding again".format(*key))
+
+    def _send_relays(self, conn, key, commands, timeout):
+        """ Sends a list of (channel, on) relay commands and records them in the
+        board's snapshot. Call with the connection lock held. Returns commands. """
+        snapshot = self._snapshots.get(key)
+        for chan, state in commands:
+            conn.request("{}{}".format("L" if state else "D", chan), "\n", timeout)
+            if snapshot is not None:
+                snapshot.set_relay(chan, state)
+        return commands
@@ -0,0 +1,195 @@
+""" Offline benchmark for the 8 Channel Network Relay plugin.
+    Runs plugin.py against simulated relay boards and a stand-in indigo module,
+    and reports sweep time, commands per second and Indigo update calls.
+
+    Usage: python2.7 bench/benchmark.py --boards 20 --devices 8 --latency 0.02
+"""
+
+import argparse
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "8chRelay.indigoPlugin", "Contents", "Server Plugin"))
+sys.path.insert(0, HERE)
+
+import indigo  # noqa: E402 - the stand-in in this directory.
+import plugin  # noqa: E402
+from simboard import SimBoard  # noqa: E402
+
+
+class Action(object):
+    """ An Indigo action: just a bag of attributes. """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1].strip())
+    parser.add_argument("--boards", type=int, default=10, help="number of simulated boards")
+    parser.add_argument("--devices", type=int, default=8, help="relay and input devices per board (max 16)")
+    parser.add_argument("--zones", type=int, default=4, help="sprinkler zones per board, 0 for none")
+    parser.add_argument("--latency", type=float, default=0.01, help="board reply latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency in seconds")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="chance a board hangs up on a request")
+    parser.add_argument("--slow-ok", type=float, default=0.0, help="delay before the DUMP OK terminator")
+    parser.add_argument("--offline", type=int, default=0, help="boards that refuse connections")
+    parser.add_argument("--sweeps", type=int, default=5, help="polling sweeps to time")
+    parser.add_argument("--commands", type=int, default=100, help="relay commands to time")
+    parser.add_argument("--timeout", type=int, default=4, help="plugin request timeout in seconds")
+    parser.add_argument("--threads", type=int, default=8, help="boards polled in parallel")
+    return parser.parse_args()
+
+
+def build(args):
+    """ Start the boards and create the plugin and its devices. """
+    prefs = {"timeout": str(args.timeout), "pollThreads": str(args.threads), "interval": "15"}
+    relay_plugin = plugin.Plugin("pro.sleepers.indigoplugin.8channel-relay", "8 Channel Network Relay", "bench", prefs)
+    indigo.activePlugin = relay_plugin
+    boards, did = list(), 1
+    for index in range(args.boards + args.offline):
+        board = SimBoard(latency=args.latency, jitter=args.jitter, drop_rate=args.drop_rate, slow_ok=args.slow_ok)
+        if index < args.boards:
+            host, port = board.start()
+        else:
+            # Nothing listens on port 1.
+            host, port = "127.0.0.1", 1
+        boards.append(board)
+        props = {"hostname": host, "port": str(port), "logChanges": False, "logActions": False}
+        for num in range(args.devices):
+            type_id, chan = ("Relay", num // 2 + 1) if num % 2 == 0 else ("Sensor", num // 2 + 1)
+            indigo.devices.add(indigo.Device(did, type_id, dict(props, channel=str(chan))))
+            did += 1
+        if args.zones:
+            zones = dict(("zoneRelay{}".format(zone), str(zone)) for zone in range(1, args.zones + 1))
+            zones.update(NumZones=str(args.zones), PumpControlOn=False,
+                         ZoneNames=",".join("Zone {}".format(zone) for zone in range(1, args.zones + 1)))
+            indigo.devices.add(indigo.Device(did, "Sprinkler", dict(props, **zones), {"activeZone": 0}))
+            did += 1
+    for dev in indigo.devices.values():
+        relay_plugin.deviceStartComm(dev)
+    return relay_plugin, boards
+
+
+def timed(func, *args, **kwargs):
+    """ Returns the seconds func took. """
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start
+
+
+def bench_sweeps(relay_plugin, boards, args):
+    """ Time full polling sweeps, flipping one input per board between sweeps. """
+    indigo.reset_calls()
+    cold = timed(relay_plugin.set_device_states, force=True, wait=True)
+    cold_updates = indigo.calls["update"]
+    steady, changed, updates = list(), list(), list()
+    for sweep in range(args.sweeps):
+        indigo.reset_calls()
+        steady.append(timed(relay_plugin.set_device_states, force=True, wait=True))
+        for board in boards:
+            board.inputs[1] = not board.inputs[1]
+        indigo.reset_calls()
+        changed.append(timed(relay_plugin.set_device_states, force=True, wait=True))
+        updates.append(indigo.calls["update"])
+    report("sweep, first", [cold], "{} update calls".format(cold_updates))
+    report("sweep, no changes", steady, "")
+    report("sweep, 1 change/board", changed, "{:.1f} update calls".format(sum(updates) / float(len(updates))))
+
+
+def bench_commands(relay_plugin, args):
+    """ Time relay commands spread across the boards. """
+    relays = [dev for dev in indigo.devices.values() if dev.deviceTypeId == "Relay" and dev.pluginProps["port"] != "1"]
+    if not relays or not args.commands:
+        return
+    failures, start = 0, time.time()
+    for num in range(args.commands):
+        dev = relays[num % len(relays)]
+        try:
+            relay_plugin.send_cmd(dev.pluginProps, "L" if num // len(relays) % 2 == 0 else "D")
+        except Exception:
+            failures += 1
+    elapsed = time.time() - start
+    print("{:24} {:8.1f} commands/s ({} commands, {} failed)"
+          .format("send_cmd", args.commands / elapsed, args.commands, failures))
+
+
+def bench_sprinklers(relay_plugin, args):
+    """ Time sprinkler zone changes: every zone in turn, then all off. """
+    sprinklers = [dev for dev in indigo.devices.values()
+                  if dev.deviceTypeId == "Sprinkler" and dev.pluginProps["port"] != "1"]
+    if not sprinklers:
+        return
+    times, settle = list(), list()
+    indigo.reset_calls()
+    for dev in sprinklers:
+        for zone in range(1, args.zones + 2):
+            if zone <= args.zones:
+                action = Action(sprinklerAction=indigo.kSprinklerAction.ZoneOn, zoneIndex=zone)
+            else:
+                action = Action(sprinklerAction=indigo.kSprinklerAction.AllZonesOff, zoneIndex=0)
+            start = time.time()
+            relay_plugin.actionControlSprinkler(action, dev)
+            times.append(time.time() - start)
+            drain_queues(relay_plugin)
+            settle.append(time.time() - start)
+    report("sprinkler action return", times, "")
+    report("sprinkler action settle", settle,
+           "{:.1f} update calls each".format(indigo.calls["update"] / float(len(times))))
+
+
+def bench_group(relay_plugin, args):
+    """ Time switching every relay on every board: one command at a time, then as one group action. """
+    relays = [dev for dev in indigo.devices.values() if dev.deviceTypeId == "Relay" and dev.pluginProps["port"] != "1"]
+    if not relays:
+        return
+    serial, group = list(), list()
+    for state in ("on", "off", "on", "off"):
+        start = time.time()
+        for dev in relays:
+            try:
+                relay_plugin.send_cmd(dev.pluginProps, "L" if state == "on" else "D")
+            except Exception:
+                pass
+        serial.append(time.time() - start)
+    for state in ("on", "off", "on", "off"):
+        start = time.time()
+        relay_plugin._group_control(Action(props={"relayDevices": [str(dev.id) for dev in relays], "groupState": state}))
+        drain_queues(relay_plugin)
+        group.append(time.time() - start)
+    report("{} relays, one by one".format(len(relays)), serial, "")
+    report("{} relays, group".format(len(relays)), group, "")
+
+
+def drain_queues(relay_plugin):
+    """ Wait for every board's queued commands to be sent. """
+    for queue in list(relay_plugin._queues.values()):
+        queue.drain()
+
+
+def report(name, samples, extra):
+    """ Print min/mean/max of a list of durations in milliseconds. """
+    samples = [sample * 1000 for sample in samples]
+    print("{:24} min {:8.1f} ms  mean {:8.1f} ms  max {:8.1f} ms  {}"
+          .format(name, min(samples), sum(samples) / len(samples), max(samples), extra))
+
+
+def main():
+    args = parse_args()
+    relay_plugin, boards = build(args)
+    print("{} boards ({} offline) x {} devices, {} zones, latency {}s, jitter {}s, drop rate {}, slow OK {}s"
+          .format(args.boards + args.offline, args.offline, args.devices, args.zones, args.latency,
+                  args.jitter, args.drop_rate, args.slow_ok))
+    bench_sweeps(relay_plugin, boards, args)
+    bench_commands(relay_plugin, args)
+    bench_sprinklers(relay_plugin, args)
+    bench_group(relay_plugin, args)
+    relay_plugin.shutdown()
+    for board in boards:
+        board.stop()
+
+
+if __name__ == "__main__":
+    main()
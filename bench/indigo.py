@@ -0,0 +1,138 @@
+""" Minimal stand-in for Indigo's indigo module, enough to run plugin.py
+    outside the Indigo server for benchmarks. Counts the calls that would be
+    IPC round trips to the server.
+"""
+
+import threading
+import time
+
+calls = {"log": 0, "update": 0, "error": 0}
+_calls_lock = threading.Lock()
+activePlugin = None
+
+
+def _count(name):
+    with _calls_lock:
+        calls[name] += 1
+
+
+def reset_calls():
+    """ Zero the call counters. """
+    for name in calls:
+        calls[name] = 0
+
+
+class Dict(dict):
+    pass
+
+
+class List(list):
+    pass
+
+
+class kDeviceAction(object):
+    TurnOn, TurnOff, Toggle = range(3)
+
+
+class kUniversalAction(object):
+    RequestStatus = 0
+
+
+class kSprinklerAction(object):
+    ZoneOn, AllZonesOff = range(2)
+
+
+class kProtocol(object):
+    Plugin = 0
+
+
+class _Server(object):
+    def __init__(self):
+        self.messages = list()
+
+    def log(self, message, type=None, isError=False):
+        _count("log")
+        self.messages.append(message)
+
+
+server = _Server()
+
+
+class Device(object):
+    """ A plugin device with the attributes plugin.py reads. """
+
+    def __init__(self, did, type_id, props, states=None):
+        self.id = did
+        self.name = u"{} {}".format(type_id, did)
+        self.deviceTypeId = type_id
+        self.pluginProps = Dict(props)
+        self.states = dict(states or {"onOffState": False})
+        self.zoneNames = props.get("ZoneNames", "").split(",")
+        self.enabled = True
+        self.configured = True
+        self.errorState = ""
+
+    def updateStateOnServer(self, key, value, **kwargs):
+        _count("update")
+        self.states[key] = value
+
+    def updateStatesOnServer(self, states):
+        _count("update")
+        for state in states:
+            self.states[state["key"]] = state["value"]
+
+    def setErrorStateOnServer(self, error):
+        _count("error")
+        self.errorState = error or ""
+
+    def refreshFromServer(self):
+        pass
+
+    def stateListOrDisplayStateIdChanged(self):
+        pass
+
+    def replacePluginPropsOnServer(self, props):
+        self.pluginProps = Dict(props)
+
+
+class _Devices(dict):
+    def iter(self, filter=None):
+        return list(self.values())
+
+    def add(self, dev):
+        self[dev.id] = dev
+        return dev
+
+
+devices = _Devices()
+
+
+class PluginBase(object):
+    """ The parts of indigo.PluginBase that plugin.py uses. """
+
+    class StopThread(Exception):
+        pass
+
+    def __init__(self, pid, name, version, prefs):
+        self.pluginId = pid
+        self.pluginPrefs = prefs
+        self.stopThread = False
+
+    def sleep(self, seconds):
+        if self.stopThread:
+            raise self.StopThread()
+        time.sleep(seconds)
+
+    def debugLog(self, message):
+        pass
+
+    def deviceStartComm(self, dev):
+        pass
+
+    def deviceStopComm(self, dev):
+        pass
+
+    def deviceUpdated(self, orig_dev, new_dev):
+        if orig_dev.pluginProps != new_dev.pluginProps:
+            self.deviceStopComm(orig_dev)
+            self.deviceStartComm(new_dev)
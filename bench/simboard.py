@@ -0,0 +1,113 @@
+""" Simulated ZM_TCP relay board for offline benchmarks.
+    Speaks the same line protocol as the real board: L(n), D(n), P(n), R(n), I(n)
+    and DUMP, each terminated with \\r\\n. See docs/ZM_TCP_Proctocol_1.0.pdf.
+"""
+
+import random
+import SocketServer
+import threading
+import time
+
+
+class BoardHandler(SocketServer.StreamRequestHandler):
+    """ Handles one client session with the simulated board. """
+
+    def handle(self):
+        board = self.server.board
+        board.connections += 1
+        self.connection.settimeout(board.idle_timeout)
+        while True:
+            try:
+                line = self.rfile.readline()
+            except Exception:
+                return
+            if not line:
+                return
+            if random.random() < board.drop_rate:
+                # Hang up mid-session like a flaky board does.
+                return
+            board.delay()
+            reply = board.handle(line.strip())
+            if reply is None:
+                continue
+            if reply.endswith("OK\r\n") and board.slow_ok > 0:
+                self.wfile.write(reply[:-4])
+                self.wfile.flush()
+                time.sleep(board.slow_ok)
+                reply = "OK\r\n"
+            self.wfile.write(reply)
+
+
+class SimBoard(object):
+    """ State and timing knobs for one simulated board. """
+
+    def __init__(self, channels=8, latency=0.0, jitter=0.0, drop_rate=0.0, slow_ok=0.0, idle_timeout=30):
+        self.channels = channels
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.slow_ok = slow_ok
+        self.idle_timeout = idle_timeout
+        self.relays = [False] * (channels + 1)
+        self.inputs = [False] * (channels + 1)
+        self.commands = list()
+        self.connections = 0
+        self._server = None
+
+    def delay(self):
+        """ Sleep for the configured latency plus jitter. """
+        pause = self.latency + random.uniform(0, self.jitter)
+        if pause > 0:
+            time.sleep(pause)
+
+    def handle(self, line):
+        """ Returns the board's reply to one command line. """
+        cmd = line.upper()
+        self.commands.append(cmd)
+        if cmd == "DUMP":
+            lines = ["Relay{} {}".format("on" if self.relays[n] else "off", n) for n in range(1, self.channels + 1)]
+            lines += ["I{} {}".format("H" if self.inputs[n] else "L", n) for n in range(1, self.channels + 1)]
+            return "\r\n".join(lines) + "\r\nOK\r\n"
+        try:
+            op, chan = cmd[0], int(cmd[1:])
+        except (IndexError, ValueError):
+            return None
+        if not 1 <= chan <= self.channels:
+            return None
+        if op == "L":
+            self.relays[chan] = True
+        elif op == "D":
+            self.relays[chan] = False
+        elif op == "P":
+            self.relays[chan] = False
+            return "Press {}\r\n".format(chan)
+        elif op == "I":
+            return "I{} {}\r\n".format("H" if self.inputs[chan] else "L", chan)
+        elif op != "R":
+            return None
+        return "Relay{} {}\r\n".format("on" if self.relays[chan] else "off", chan)
+
+    def start(self, host="127.0.0.1", port=0):
+        """ Start serving on a background thread. Returns the (host, port) in use. """
+        self._server = ThreadedServer((host, port), BoardHandler)
+        self._server.board = self
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self._server.server_address
+
+    def stop(self):
+        """ Stop serving. """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+class ThreadedServer(SocketServer.ThreadingTCPServer):
+    """ One thread per client session, like the board's own TCP stack. """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        """ Clients hanging up are expected; stay quiet. """
+        pass
@@ -0,0 +1,125 @@
+""" Tests for the DUMP reply parser, the BoardState snapshot and relay_commands.
+    Runs against the stand-in indigo module in bench/:
+
+    Usage: python2.7 -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "8chRelay.indigoPlugin", "Contents", "Server Plugin"))
+sys.path.insert(0, os.path.join(HERE, "..", "bench"))
+
+from plugin import BoardState, parse_dump, relay_commands  # noqa: E402
+
+# An 8 channel board's reply to DUMP, in the format of docs/ZM_TCP_Proctocol_1.0.pdf:
+# relays 1 and 3 on, input 2 high.
+SAMPLE_DUMP = ("Relayon 1\r\nRelayoff 2\r\nRelayon 3\r\nRelayoff 4\r\n"
+               "Relayoff 5\r\nRelayoff 6\r\nRelayoff 7\r\nRelayoff 8\r\n"
+               "IL 1\r\nIH 2\r\nIL 3\r\nIL 4\r\nIL 5\r\nIL 6\r\nIL 7\r\nIL 8\r\n"
+               "OK\r\n")
+
+
+def dump(*lines):
+    """ Build a DUMP reply from status lines. """
+    return "\r\n".join(lines + ("OK",)) + "\r\n"
+
+
+class ParseDumpTest(unittest.TestCase):
+    """ parse_dump() against sample and unusual replies. """
+
+    def test_sample_reply(self):
+        state = parse_dump(SAMPLE_DUMP)
+        self.assertEqual(state.relays, 0b101)
+        self.assertEqual(state.inputs, 0b10)
+        self.assertEqual([state.relay(chan) for chan in range(1, 9)],
+                         [True, False, True, False, False, False, False, False])
+        self.assertEqual([state.input(chan) for chan in range(1, 9)],
+                         [False, True, False, False, False, False, False, False])
+
+    def test_mixed_case(self):
+        state = parse_dump(dump("Relayon 1", "RELAYON 2", "relayOn 3", "RELAYOFF 4", "ih 5", "Il 6"))
+        self.assertEqual(state.relays, 0b111)
+        self.assertEqual(state.inputs, 0b10000)
+
+    def test_two_digit_channels(self):
+        state = parse_dump(dump("Relayoff 1", "Relayon 10", "Relayon 16", "IL 1", "IH 12"))
+        self.assertFalse(state.relay(1))
+        self.assertTrue(state.relay(10))
+        self.assertTrue(state.relay(16))
+        self.assertFalse(state.input(1))
+        self.assertTrue(state.input(12))
+
+    def test_line_endings_and_whitespace(self):
+        expected = parse_dump(dump("Relayon 2", "IH 3"))
+        for reply in ("Relayon 2\nIH 3\nOK\n",
+                      "Relayon 2  \r\n  IH 3\t\r\nOK  \r\n",
+                      "\r\nRelayon   2\r\n\r\nIH 3\r\nOK"):
+            state = parse_dump(reply)
+            self.assertEqual((state.relays, state.inputs), (expected.relays, expected.inputs), repr(reply))
+
+    def test_truncated_reply(self):
+        self.assertRaises(ValueError, parse_dump, SAMPLE_DUMP[:-len("OK\r\n")])
+        self.assertRaises(ValueError, parse_dump, "Relayon 1\r\nRelayo")
+        self.assertRaises(ValueError, parse_dump, "")
+
+    def test_channel_zero_and_garbage(self):
+        state = parse_dump(dump("Relayon 0", "IH 0", "Relayon x", "Press 1", "garbage", "Relayon 1 2",
+                                "IH", "Relayon 4"))
+        self.assertEqual(state.relays, 0b1000)
+        self.assertEqual(state.inputs, 0)
+
+
+class BoardStateTest(unittest.TestCase):
+    """ BoardState lookups and relay updates. """
+
+    def test_lookups(self):
+        state = BoardState(relays=0b1001, inputs=0b10)
+        self.assertTrue(state.relay(1))
+        self.assertFalse(state.relay(2))
+        self.assertTrue(state.relay(4))
+        self.assertFalse(state.relay(9))
+        self.assertTrue(state.input(2))
+        self.assertFalse(state.input(1))
+
+    def test_out_of_range_channels(self):
+        state = BoardState(relays=-1, inputs=-1)
+        self.assertFalse(state.relay(0))
+        self.assertFalse(state.relay(-1))
+        self.assertFalse(state.input(0))
+
+    def test_set_relay(self):
+        state = BoardState()
+        state.set_relay(3, True)
+        state.set_relay(10, True)
+        self.assertEqual(state.relays, 0b1000000100)
+        state.set_relay(3, False)
+        state.set_relay(3, False)
+        self.assertEqual(state.relays, 0b1000000000)
+        self.assertEqual(state.inputs, 0)
+
+
+class RelayCommandsTest(unittest.TestCase):
+    """ relay_commands() ordering and deduplication. """
+
+    def test_offs_first(self):
+        commands = relay_commands(BoardState(relays=0b1100), {1: True, 3: False, 2: True, 4: False})
+        self.assertEqual(commands, [(3, False), (4, False), (1, True), (2, True)])
+
+    def test_skips_relays_already_set(self):
+        snapshot = BoardState(relays=0b0101)
+        self.assertEqual(relay_commands(snapshot, {1: True, 2: False, 3: True, 4: False}), list())
+        self.assertEqual(relay_commands(snapshot, {1: False, 2: True}), [(1, False), (2, True)])
+
+    def test_no_snapshot(self):
+        self.assertEqual(relay_commands(None, {2: True, 1: False, 3: True}),
+                         [(1, False), (2, True), (3, True)])
+
+    def test_empty(self):
+        self.assertEqual(relay_commands(BoardState(), dict()), list())
+
+
+if __name__ == "__main__":
+    unittest.main()